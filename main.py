@@ -1,29 +1,63 @@
 # Detects and handles spam messages in UNLV discord servers
 # Written on 11/4/2025 by GitHub/theplaceincan
 
+import asyncio
+import atexit
+import array
+import bisect
 import json
+import math
+import struct
+import time
 import discord
+from dataclasses import dataclass, asdict
 from datetime import datetime
 from discord.ext import commands
 import logging
 from dotenv import load_dotenv
 import os
-from typing import List, cast
-from openai import AsyncOpenAI, RateLimitError
+from typing import Dict, List, Optional, Set, cast
+from openai import DEFAULT_CONNECTION_LIMITS, AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, Timeout
 from openai.types.chat import (
     ChatCompletionMessageParam,
     ChatCompletionSystemMessageParam,
     ChatCompletionUserMessageParam,
 )
 import re
-from collections import defaultdict
+import hashlib
+from collections import defaultdict, OrderedDict
+# Optional: with redis installed and REDIS_URL set, caches and counters are shared across shards
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 from datetime import timedelta
+from spam_filter import (
+    MIN_SUSPICIOUS_LENGTH,
+    AuthorAges,
+    account_age_days,
+    check_if_possible_spam,
+    member_join_age_days,
+)
 
 load_dotenv()
 token = os.getenv('DISCORD_TOKEN')
 openai_key = os.getenv('OPENAI_TOKEN')
 
-client = AsyncOpenAI(api_key=openai_key)
+# One long-lived HTTP/2 pool, so bursts reuse warm connections instead of new TLS handshakes.
+# DefaultAsyncHttpxClient keeps the SDK's other defaults, like following redirects
+# Timeout and Limits come from the SDK, which may be built on httpx or httpx2
+Limits = type(DEFAULT_CONNECTION_LIMITS)
+OPENAI_TIMEOUT = Timeout(10.0, connect=5.0)
+OPENAI_FILE_TIMEOUT = Timeout(600.0, connect=5.0) # batch file upload/download
+http_client = DefaultAsyncHttpxClient(
+    http2=True,
+    limits=Limits(max_keepalive_connections=50, max_connections=50, keepalive_expiry=60.0),
+    timeout=OPENAI_TIMEOUT,
+)
+client = AsyncOpenAI(api_key=openai_key, http_client=http_client, timeout=OPENAI_TIMEOUT)
+# Same connection pool, longer timeout for the Batch API's files.* calls
+files_client = client.with_options(timeout=OPENAI_FILE_TIMEOUT)
 
 handler = logging.FileHandler(filename='SpamRemover.log', encoding='utf-8', mode='w')
 intents = discord.Intents.default()
@@ -36,6 +70,12 @@ message_logger = logging.getLogger('deleted_messages')
 message_logger.addHandler(message_handler)
 message_logger.setLevel(logging.INFO)
 
+# Per-message trace output, debug calls are skipped with a single level check at INFO.
+# discord.py's logging setup only attaches its handler to the discord logger, so attach it here too
+logger = logging.getLogger('spam_remover')
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
 bot = commands.Bot(command_prefix='!', intents=intents)
 
 OPENAI_MODEL = "gpt-4o-mini"
@@ -45,40 +85,116 @@ SYSTEM_PROMPT = (
     "Look for: scholarship scams, fake giveaways, phishing, suspicious offers, "
     "emotional manipulation, urgency tactics, and 'DM me' solicitations."
 )
+BATCH_SYSTEM_PROMPT = (
+    "You are a spam detector for a college Discord server. "
+    "You will get a numbered list of messages, each written as a JSON string. "
+    "Reply with exactly one line per message in the form '<number>. SPAM' or '<number>. NOT_SPAM', "
+    "and nothing else. "
+    "Look for: scholarship scams, fake giveaways, phishing, suspicious offers, "
+    "emotional manipulation, urgency tactics, and 'DM me' solicitations."
+)
 
-user_spam_attempts = defaultdict(list)
-user_spam_detected = defaultdict(int)
 MAX_SUS_MESSAGES = 5
 TIME_WINDOW = 60 # sec
+# Monotonic timestamps of each user's suspicious messages, oldest first.
+# Packed doubles take 8 bytes each and stay sorted, so the window cutoff is a binary search
+user_spam_attempts = defaultdict(lambda: array.array('d'))
+user_spam_detected = defaultdict(int)
 TIMEOUT_DURATION = timedelta(minutes=10)
 
 # ------- Metrics -------
 METRICS_FILE = "SpamRemoverMetrics.json"
+# Counters are flushed as a fixed 32-byte record while running, the JSON is
+# only rewritten on shutdown for humans to read
+METRICS_BIN_FILE = "SpamRemoverMetrics.bin"
+METRICS_COUNTERS = ("total_messages", "filtered_locally", "sent_to_api", "spam_detected")
+METRICS_STRUCT = struct.Struct('<4q')
 
 def load_metrics():
     try:
         with open(METRICS_FILE, 'r') as f:
-            return json.load(f)
+            metrics_ = json.load(f)
     except FileNotFoundError:
-        return {
+        metrics_ = {
             "total_messages": 0,
             "filtered_locally": 0,
             "sent_to_api": 0,
             "spam_detected": 0,
             "start_date": str(datetime.now())
         }
+    # The binary record survives crashes, so it's at least as new as the JSON
+    try:
+        with open(METRICS_BIN_FILE, 'rb') as f:
+            record = f.read(METRICS_STRUCT.size)
+        if len(record) == METRICS_STRUCT.size:
+            metrics_.update(zip(METRICS_COUNTERS, METRICS_STRUCT.unpack(record)))
+    except FileNotFoundError:
+        pass
+    return metrics_
 
-def save_metrics(metrics_):
-    with open(METRICS_FILE, 'w') as f:
-        json.dump(metrics_, f, indent=2)
+METRICS_FLUSH_INTERVAL = 5 # sec
+metrics_dirty = False
+metrics_flusher_task = None
+metrics_fd = None
+metrics_record = bytearray(METRICS_STRUCT.size)
 
-metrics_data = load_metrics()
+def write_metrics(metrics_):
+    with open(METRICS_FILE, 'w') as f:
+        json.dump(asdict(metrics_), f)
+
+def write_metrics_record(metrics_):
+    global metrics_fd
+    if metrics_fd is None:
+        metrics_fd = os.open(METRICS_BIN_FILE, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+    METRICS_STRUCT.pack_into(metrics_record, 0, metrics_.total_messages, metrics_.filtered_locally,
+                             metrics_.sent_to_api, metrics_.spam_detected)
+    os.lseek(metrics_fd, 0, os.SEEK_SET)
+    os.write(metrics_fd, metrics_record)
+
+# Only marks metrics as changed, metrics_flusher writes them out in the background
+def save_metrics(metrics_):
+    global metrics_dirty
+    metrics_dirty = True
+
+async def metrics_flusher():
+    global metrics_dirty
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        if not metrics_dirty:
+            continue
+        metrics_dirty = False
+        try:
+            # A 32-byte overwrite into the page cache, cheap enough to do on the loop
+            write_metrics_record(metrics)
+        except OSError as e:
+            metrics_dirty = True
+            logger.error("Error saving metrics: %s", e)
+        await push_shared_metrics()
+
+# Writes the final counters and the readable JSON copy when the bot shuts down
+def flush_metrics():
+    write_metrics_record(metrics)
+    write_metrics(metrics)
+    if metrics_fd is not None:
+        os.close(metrics_fd)
+
+# Slots make each counter bump a single attribute store instead of two dict lookups
+@dataclass(slots=True)
+class Metrics:
+    total_messages: int = 0
+    filtered_locally: int = 0
+    sent_to_api: int = 0
+    spam_detected: int = 0
+    start_date: str = ''
+
+metrics = Metrics(**load_metrics())
+atexit.register(flush_metrics)
 
 def print_metrics():
-    total_messages = metrics_data['total_messages']
-    filtered_locally = metrics_data['filtered_locally']
-    api_calls = metrics_data['sent_to_api']
-    spam_detected = metrics_data['spam_detected']
+    total_messages = metrics.total_messages
+    filtered_locally = metrics.filtered_locally
+    api_calls = metrics.sent_to_api
+    spam_detected = metrics.spam_detected
     if total_messages > 0:
         reduction = (filtered_locally / total_messages) * 100
         print("SpamRemover Metrics")
@@ -90,113 +206,658 @@ def print_metrics():
         print(f"API cost reduction: {reduction}")
         print(f"{'='*50}")
 
-# ------- Functions -------
-
-# Checks age of account
-def account_age_days(member: discord.Member):
-    created = member.created_at.replace(tzinfo=None)
-    days = (datetime.now() - created).days
-    return days
-
-def member_join_age_days(member: discord.Member):
-    if not isinstance(member, discord.Member) or member.joined_at is None:
-        return 9999
-    return (datetime.now() - member.joined_at.replace(tzinfo=None)).days
-
-LINK_RE = re.compile(r'(https?://\S+|discord\.gg/\S+|t\.me/\S+)', re.I)
-
-# Checks whether we should call the API
-def check_if_possible_spam(message):
-    content = message.content
-    lower = content.lower()
-
-    # If messages short, then likely a regular convo
-    if len(content) < 20:
-        return False
-
-    # If @everyone or @here, check
-    if '@everyone' in content or '@here' in content:
-        if len(message.author.roles) > 2:
-            print("Mass mention likely from trusted user, likely an announcement")
-            return False
-        print("Possible scam, mass mention")
-        return True
-
-    # If it has links, then must check if spam
-    if LINK_RE.search(content):
-        print("Possible scam, has links")
-        return True
-
-    # If new account, check
-    if account_age_days(message.author) < 7: # created recently
-        print("Possible scam, new account")
-        return True
-
-    # If user joined recently check
-    if member_join_age_days(message.author) < 7: # joined recently
-        print("Possible scam, new member")
+# ------- Rate limiting -------
+# Waits locally for request/token capacity instead of bouncing off OpenAI's rate limit.
+# Capacity refills continuously, same approach as the OpenAI cookbook's parallel processor
+OPENAI_RPM = 500
+OPENAI_TPM = 200_000
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.max_requests = requests_per_minute
+        self.max_tokens = tokens_per_minute
+        self.available_request_capacity = float(requests_per_minute)
+        self.available_token_capacity = float(tokens_per_minute)
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_request_capacity = min(
+            self.max_requests, self.available_request_capacity + elapsed * self.max_requests / 60)
+        self.available_token_capacity = min(
+            self.max_tokens, self.available_token_capacity + elapsed * self.max_tokens / 60)
+
+    async def acquire(self, estimated_tokens: int):
+        estimated_tokens = min(estimated_tokens, self.max_tokens)
+        # Lock keeps waiters in order so a big request can't be starved
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= estimated_tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= estimated_tokens
+                    return
+                request_wait = (1 - self.available_request_capacity) * 60 / self.max_requests
+                token_wait = (estimated_tokens - self.available_token_capacity) * 60 / self.max_tokens
+                await asyncio.sleep(max(request_wait, token_wait, 0.01))
+
+openai_bucket = TokenBucket(OPENAI_RPM, OPENAI_TPM)
+
+# Rough token count, ~4 characters per token plus the reply budget
+def estimate_tokens(prompt_chars: int, max_tokens: int) -> int:
+    return prompt_chars // 4 + max_tokens
+
+# ------- Spam cache -------
+# Remembers content hashes of messages the AI already flagged as spam,
+# so repeated copy-paste raids skip the API entirely
+SPAM_CACHE_FILE = "spam_cache.json"
+SPAM_CACHE_SIZE = 4096
+
+def load_spam_cache():
+    try:
+        with open(SPAM_CACHE_FILE, 'r') as f:
+            return OrderedDict((key, True) for key in json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return OrderedDict()
+
+def save_spam_cache(cache):
+    # Write to a temp file then swap, so a crash never leaves a half-written cache
+    tmp_file = SPAM_CACHE_FILE + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(list(cache), f)
+    os.replace(tmp_file, SPAM_CACHE_FILE)
+
+spam_cache = load_spam_cache()
+
+def content_key(message_content: str) -> str:
+    return hashlib.sha256(message_content.strip().lower().encode()).hexdigest()
+
+def cached_verdict(key: str) -> Optional[bool]:
+    if key in spam_cache:
+        spam_cache.move_to_end(key)
         return True
+    return None
+
+# ------- Near-duplicate spam -------
+# A Bloom filter of word shingles from confirmed spam spots raid waves that
+# slightly mutate their payload, which the exact-hash cache above misses.
+# A hit is only a hint: the message still goes to the API, just on the fast path
+SPAM_BLOOM_FILE = "spam_bloom.bin"
+SPAM_BLOOM_CAPACITY = 100_000
+SPAM_BLOOM_ERROR_RATE = 0.001
+SHINGLE_SIZE = 5 # words
+NEAR_DUP_MIN_OVERLAP = 0.5 # share of a message's shingles already seen in spam
+SPAM_STATE_FLUSH_INTERVAL = 30 # sec
+WHITESPACE_RE = re.compile(r'\s+')
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float, bits: Optional[bytearray] = None, count: int = 0):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        if bits is not None and len(bits) == (self.size + 7) // 8:
+            self.bits = bits
+            self.count = count
+        else:
+            self.bits = bytearray((self.size + 7) // 8)
+            self.count = 0
+
+    def positions(self, item: str):
+        # Double hashing: k bit positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        # Past capacity the false-positive rate climbs fast, so start over instead
+        if self.count >= self.capacity:
+            self.bits = bytearray(len(self.bits))
+            self.count = 0
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
+
+# File layout: 8-byte insert count, then the bit array
+SPAM_BLOOM_HEADER = struct.Struct('<q')
+
+def load_spam_bloom():
+    bits, count = None, 0
+    try:
+        with open(SPAM_BLOOM_FILE, 'rb') as f:
+            data = f.read()
+        if len(data) > SPAM_BLOOM_HEADER.size:
+            (count,) = SPAM_BLOOM_HEADER.unpack_from(data)
+            bits = bytearray(data[SPAM_BLOOM_HEADER.size:])
+    except FileNotFoundError:
+        pass
+    return BloomFilter(SPAM_BLOOM_CAPACITY, SPAM_BLOOM_ERROR_RATE, bits, count)
+
+def save_spam_bloom(count: int, bits: bytes):
+    tmp_file = SPAM_BLOOM_FILE + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(SPAM_BLOOM_HEADER.pack(count))
+        f.write(bits)
+    os.replace(tmp_file, SPAM_BLOOM_FILE)
+
+spam_bloom = load_spam_bloom()
+spam_state_dirty = False
+spam_state_flusher_task = None
+
+def shingles(message_content: str) -> List[str]:
+    words = WHITESPACE_RE.sub(' ', message_content.lower().strip()).split(' ')
+    if len(words) <= SHINGLE_SIZE:
+        return [' '.join(words)]
+    return [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+def looks_like_known_spam(message_content: str) -> bool:
+    message_shingles = shingles(message_content)
+    seen = sum(1 for shingle in message_shingles if shingle in spam_bloom)
+    return seen >= NEAR_DUP_MIN_OVERLAP * len(message_shingles)
+
+def remember_spam(key: str, message_content: str):
+    global spam_state_dirty
+    spam_cache[key] = True
+    spam_cache.move_to_end(key)
+    while len(spam_cache) > SPAM_CACHE_SIZE:
+        spam_cache.popitem(last=False)
+    for shingle in shingles(message_content):
+        spam_bloom.add(shingle)
+    spam_state_dirty = True
+
+# Cache and Bloom filter are persisted periodically, not on every confirmed spam
+async def spam_state_flusher():
+    global spam_state_dirty
+    while True:
+        await asyncio.sleep(SPAM_STATE_FLUSH_INTERVAL)
+        if not spam_state_dirty:
+            continue
+        spam_state_dirty = False
+        try:
+            await asyncio.to_thread(save_spam_cache, OrderedDict(spam_cache))
+            await asyncio.to_thread(save_spam_bloom, spam_bloom.count, bytes(spam_bloom.bits))
+        except OSError as e:
+            spam_state_dirty = True
+            logger.error("Error saving spam cache: %s", e)
+
+def flush_spam_state():
+    if spam_state_dirty:
+        save_spam_cache(spam_cache)
+        save_spam_bloom(spam_bloom.count, spam_bloom.bits)
+
+atexit.register(flush_spam_state)
+
+# ------- Shared state -------
+# With Redis, every shard and restart sees the same verdict cache, spam windows,
+# offense counts and metrics. Without it the in-process state above is used alone.
+# Redis errors are logged and fall back to local state, same as API errors
+REDIS_URL = os.getenv('REDIS_URL')
+SHARED_CACHE_TTL = 86400 # sec
+
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if aioredis and REDIS_URL else None
+# Counters loaded from disk were pushed by earlier runs, only new increments are shared
+metrics_pushed = {counter: getattr(metrics, counter) for counter in METRICS_COUNTERS}
+
+async def shared_spam_verdicts(keys: List[str]) -> List[bool]:
+    if redis_client is None or not keys:
+        return [False] * len(keys)
+    try:
+        values = await redis_client.mget([f"spam_cache:{key}" for key in keys])
+    except Exception as e:
+        logger.error("Error reading shared spam cache: %s", e)
+        return [False] * len(keys)
+    return [value is not None for value in values]
 
-    # If message has sus words, check
-    scam_patterns = [
-        r'\bdm\b',  # matches "DM" as standalone word
-        r'\bgiving?\s+out\b',  # matches "give out" or "giving out"
-        r'\bfree\b',
-        r'\bgiveaway\b',
-        r'\bloan\b',
-        r'\bgrant\b',
-        r'\bcashapp\b',
-        r'\bvenmo\b',
-        r'\bcrypto\b',
-        r'\bairdrop\b',
-        r'\binvestment\b',
-        r'\bquick\s+money\b',
-        r'\bperfect\s+condition\b',
-        r'\blimited\s+time\b',
-        r'\burgent\b',
-        r'\bfirst\s+come\s+first\s+serve\b',
-    ]
-    if any(re.search(pattern, lower) for pattern in scam_patterns):
-        print("Possible scam, scammy words")
-        return True
+async def share_spam_verdict(key: str):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(f"spam_cache:{key}", 1, ex=SHARED_CACHE_TTL)
+    except Exception as e:
+        logger.error("Error writing shared spam cache: %s", e)
+
+# Redis keeps the sliding window server-side, returns None when it isn't available
+async def record_shared_attempt(user_id: int, message_id: int) -> Optional[int]:
+    if redis_client is None:
+        return None
+    now = time.time()
+    key = f"spam:{user_id}"
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, {str(message_id): now})
+            pipe.zremrangebyscore(key, 0, now - TIME_WINDOW)
+            pipe.zcard(key)
+            pipe.expire(key, TIME_WINDOW)
+            _, _, attempt_count, _ = await pipe.execute()
+        return attempt_count
+    except Exception as e:
+        logger.error("Error updating shared spam window: %s", e)
+        return None
 
-    # If trusted user, skip
-    # if len(message.author.roles) > 1:
-    #     print("Likely safe, user has multiple roles")
-    #     return False
+async def clear_shared_attempts(user_id: int):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(f"spam:{user_id}")
+    except Exception as e:
+        logger.error("Error clearing shared spam window: %s", e)
 
-    # Otherwise, probably safe
-    print("Likely safe, no suspicion found")
-    return False
+async def record_shared_offense(user_id: int) -> Optional[int]:
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.hincrby("spam_offenses", str(user_id), 1)
+    except Exception as e:
+        logger.error("Error updating shared offense count: %s", e)
+        return None
 
+# Adds this instance's counter increments since the last push, one round trip per flush
+async def push_shared_metrics():
+    if redis_client is None:
+        return
+    deltas = {counter: getattr(metrics, counter) - metrics_pushed.get(counter, 0) for counter in METRICS_COUNTERS}
+    deltas = {counter: delta for counter, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    # Reserve the deltas before awaiting so a concurrent push can't send them again
+    for counter, delta in deltas.items():
+        metrics_pushed[counter] = metrics_pushed.get(counter, 0) + delta
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for counter, delta in deltas.items():
+                pipe.hincrby("metrics", counter, delta)
+            await pipe.execute()
+    except Exception as e:
+        logger.error("Error pushing shared metrics: %s", e)
+        # Hand the deltas back so the next push retries them
+        for counter, delta in deltas.items():
+            metrics_pushed[counter] -= delta
+
+async def load_shared_metrics() -> Optional[dict]:
+    if redis_client is None:
+        return None
+    try:
+        values = await redis_client.hgetall("metrics")
+    except Exception as e:
+        logger.error("Error reading shared metrics: %s", e)
+        return None
+    return {counter: int(values.get(counter, 0)) for counter in METRICS_COUNTERS}
+
+# Calls the API right away to check a batch of messages, one verdict per message
+async def is_spam_online(message_contents: List[str]) -> List[bool]:
+    verdicts = [False] * len(message_contents)
+    keys = [content_key(content) for content in message_contents]
+
+    pending = []
+    for i, (content, key) in enumerate(zip(message_contents, keys)):
+        if cached_verdict(key):
+            logger.debug("Cached spam verdict for message: %.50s...", content)
+            verdicts[i] = True
+        else:
+            pending.append(i)
+
+    # Another shard or an earlier run may already have flagged it
+    shared_hits = await shared_spam_verdicts([keys[i] for i in pending])
+    for i, hit in zip(pending, shared_hits):
+        if hit:
+            logger.debug("Shared spam verdict for message: %.50s...", message_contents[i])
+            remember_spam(keys[i], message_contents[i])
+            verdicts[i] = True
+    unresolved = [i for i in pending if not verdicts[i]]
+    if not unresolved:
+        return verdicts
+    # Identical messages in one batch are classified once, duplicates copy the verdict
+    first_index: Dict[str, int] = {}
+    for i in unresolved:
+        first_index.setdefault(keys[i], i)
+    pending = list(first_index.values())
 
-# Calls the API to check if spam
-async def is_spam(message_content: str) -> bool:
     try:
+        # JSON-encode each message so newlines inside it can't fake extra numbered items
+        numbered = "\n".join(f"{n}. {json.dumps(message_contents[i])}" for n, i in enumerate(pending, start=1))
         messages: List[ChatCompletionMessageParam] = [
-            cast(ChatCompletionSystemMessageParam, {"role": "system", "content": SYSTEM_PROMPT}),
+            cast(ChatCompletionSystemMessageParam, {"role": "system", "content": BATCH_SYSTEM_PROMPT}),
             cast(ChatCompletionUserMessageParam,
-                 {"role": "user", "content": f"Is this message spam?\n\nMessage: {message_content}"}),
+                 {"role": "user", "content": "Classify each message. Reply with one line per message "
+                                             f"(SPAM/NOT_SPAM).\n{numbered}"}),
         ]
 
+        max_tokens = 10 * len(pending)
+        prompt_chars = len(BATCH_SYSTEM_PROMPT) + len(numbered)
+        await openai_bucket.acquire(estimate_tokens(prompt_chars, max_tokens))
+
         resp = await client.chat.completions.create(
             model=OPENAI_MODEL,
             messages=messages,
-            max_tokens=10,
+            max_tokens=max_tokens,
         )
 
-        result = (resp.choices[0].message.content or "").strip().upper()
-
-        print(f"AI Response: {result} for message: {message_content[:50]}...")
-        logging.info(f"AI said '{result}' for: {message_content[:100]}")
-        return result == "SPAM"
+        results = parse_batch_verdicts(resp.choices[0].message.content or "", len(pending))
+        if results is None:
+            logger.warning("AI reply didn't have one verdict per message for %d messages"
+                           " - letting messages through", len(pending))
+            return verdicts
+
+        for i, result in zip(pending, results):
+            content = message_contents[i]
+            logger.debug("AI Response: %s for message: %.50s...", result, content)
+            logger.info("AI said '%s' for: %.100s", result, content)
+            # Only cache positives, a NOT_SPAM verdict may be re-checked later
+            if result == "SPAM":
+                remember_spam(keys[i], message_contents[i])
+                await share_spam_verdict(keys[i])
+                verdicts[i] = True
+        for i in unresolved:
+            verdicts[i] = verdicts[first_index[keys[i]]]
+        return verdicts
 
     except RateLimitError:
-        logging.warning("Rate limited by OpenAI - letting message through")
-        return False
+        logger.warning("Rate limited by OpenAI - letting messages through")
+        return verdicts
     except Exception as e:
-        logging.error(f"Error checking spam: {e}")
-        return False
+        logger.error("Error checking spam: %s", e)
+        return verdicts
+
+# ------- Batching -------
+# Suspicious messages are queued and classified together, so a raid burst
+# costs one API call per batch instead of one per message
+BATCH_SIZE = 8
+BATCH_WINDOW_MS = 200
+MAX_CONCURRENT_BATCHES = 4
+VERDICT_LINE_RE = re.compile(r'^\s*(\d+)[.):]\s*(.*)$')
+
+# Maps "<number>. SPAM/NOT_SPAM" lines back to their messages by number, never by position.
+# Unnumbered lines are ignored; a missing, repeated or unreadable verdict fails the whole batch
+def parse_batch_verdicts(reply: str, count: int) -> Optional[List[str]]:
+    results = {}
+    for line in reply.splitlines():
+        match = VERDICT_LINE_RE.match(line)
+        if not match:
+            continue
+        number = int(match.group(1))
+        result = match.group(2).strip().strip('*').strip().upper()
+        if result not in ("SPAM", "NOT_SPAM") or not 1 <= number <= count or number in results:
+            return None
+        results[number] = result
+    if len(results) != count:
+        return None
+    return [results[number] for number in range(1, count + 1)]
+
+classification_queue: asyncio.Queue = asyncio.Queue()
+batch_worker_task = None
+batch_slots = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+batch_tasks: Set[asyncio.Task] = set()
+
+async def enqueue_for_classification(message_content: str) -> bool:
+    future = asyncio.get_running_loop().create_future()
+    await classification_queue.put((message_content, future))
+    return await future
+
+async def run_batch(batch):
+    try:
+        try:
+            verdicts = await is_spam_online([content for content, _ in batch])
+        except Exception as e:
+            logger.exception("Batch classification crashed: %s", e)
+            verdicts = [False] * len(batch)
+        for (_, future), verdict in zip(batch, verdicts):
+            if not future.done():
+                future.set_result(verdict)
+    finally:
+        batch_slots.release()
+
+# Each drained batch runs as its own task so one slow API call doesn't hold up the next
+async def batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await classification_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(classification_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        await batch_slots.acquire()
+        task = asyncio.create_task(run_batch(batch))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+# ------- Offline batches -------
+# Suspicion from established accounts isn't urgent, so it goes through the Batch API
+# at half the cost and outside the online rate limit. Spam is deleted once results arrive
+OFFLINE_BATCH_INTERVAL = 300 # sec
+OFFLINE_BATCHES_FILE = "offline_batches.json"
+URGENT_ACCOUNT_AGE_DAYS = 7
+
+offline_batch_task = None
+
+# State file holds rows not yet submitted, plus each submitted batch id mapped
+# to the custom_ids whose results were already applied
+def load_offline_state():
+    try:
+        with open(OFFLINE_BATCHES_FILE, 'r') as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return [], {}
+    if isinstance(state, list): # older files only listed batch ids
+        return [], {batch_id: [] for batch_id in state}
+    return state.get("pending", []), state.get("batches", {})
+
+def save_offline_state():
+    with open(OFFLINE_BATCHES_FILE, 'w') as f:
+        json.dump({"pending": offline_pending, "batches": offline_batches}, f)
+
+offline_pending, offline_batches = load_offline_state()
+# Rows queued since the last submit would otherwise be lost on shutdown
+atexit.register(save_offline_state)
+
+# Queues a message for the next offline batch, returns True only when it's already known spam
+async def is_spam_offline(message) -> bool:
+    key = content_key(message.content)
+    if cached_verdict(key):
+        logger.debug("Cached spam verdict for message: %.50s...", message.content)
+        return True
+    if (await shared_spam_verdicts([key]))[0]:
+        logger.debug("Shared spam verdict for message: %.50s...", message.content)
+        remember_spam(key, message.content)
+        return True
+    offline_pending.append({
+        "custom_id": f"{message.channel.id}-{message.id}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": OPENAI_MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": f"Is this message spam?\n\nMessage: {message.content}"},
+            ],
+            "max_tokens": 10,
+        },
+    })
+    return False
+
+async def submit_offline_batch():
+    rows = offline_pending[:]
+    offline_pending.clear()
+    jsonl = "\n".join(json.dumps(row) for row in rows).encode()
+    try:
+        batch_file = await files_client.files.create(file=("spam_batch.jsonl", jsonl), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    except Exception as e:
+        logger.error("Error submitting offline batch: %s", e)
+        offline_pending.extend(rows) # retry next round
+        return
+    logger.info("Submitted offline batch %s with %d messages", batch.id, len(rows))
+    offline_batches[batch.id] = []
+    save_offline_state()
+
+# Skips rows already applied, so a retry after a partial failure never acts on a message twice
+async def apply_offline_results(batch_id: str, output_file_id: str):
+    handled = set(offline_batches[batch_id])
+    output = await files_client.files.content(output_file_id)
+    try:
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get("custom_id") in handled:
+                continue
+            # Marked before acting, a row that fails halfway is dropped rather than repeated
+            handled.add(row.get("custom_id"))
+            await apply_offline_row(row)
+    finally:
+        offline_batches[batch_id] = list(handled)
+        save_offline_state()
+
+async def apply_offline_row(row: dict):
+    try:
+        body = row["response"]["body"]
+        result = (body["choices"][0]["message"]["content"] or "").strip().upper()
+    except (KeyError, IndexError, TypeError):
+        logger.error("Bad offline batch row: %s", row.get('custom_id'))
+        return
+    if result != "SPAM":
+        return
+
+    channel_id, message_id = (int(part) for part in row["custom_id"].split("-"))
+    try:
+        channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+        message = await channel.fetch_message(message_id)
+    except discord.errors.NotFound:
+        return # already deleted
+    except Exception as e:
+        logger.error("Error fetching message %s for offline verdict: %s", message_id, e)
+        return
+
+    logger.debug("Offline batch found spam: %.50s...", message.content)
+    logger.info("AI said '%s' for: %.100s", result, message.content)
+    key = content_key(message.content)
+    remember_spam(key, message.content)
+    await share_spam_verdict(key)
+    await handle_spam(message, account_age_days(message.author), member_join_age_days(message.author))
+
+async def poll_offline_batches():
+    for batch_id in list(offline_batches):
+        try:
+            batch = await client.batches.retrieve(batch_id)
+        except Exception as e:
+            logger.error("Error checking offline batch %s: %s", batch_id, e)
+            continue
+        if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            continue
+        if batch.status != "completed":
+            logger.warning("Offline batch %s ended as %s", batch_id, batch.status)
+        # Expired and cancelled batches can still carry the rows that finished in time
+        if batch.output_file_id:
+            try:
+                await apply_offline_results(batch_id, batch.output_file_id)
+            except Exception as e:
+                logger.error("Error applying offline batch %s: %s", batch_id, e)
+                continue
+        del offline_batches[batch_id]
+        save_offline_state()
+
+async def offline_batch_worker():
+    while True:
+        await asyncio.sleep(OFFLINE_BATCH_INTERVAL)
+        if offline_pending:
+            await submit_offline_batch()
+        await poll_offline_batches()
+
+# ------- Bulk moderation -------
+# Spam is deleted per channel after a short delay, so a raid burst becomes one bulk
+# delete and one warning instead of a REST call per message
+DELETE_FLUSH_DELAY = 0.5 # sec
+BULK_DELETE_LIMIT = 100
+
+pending_deletes = defaultdict(list)
+pending_warnings = defaultdict(list)
+delete_flush_tasks = {}
+
+def queue_delete(message, warn: bool = False):
+    channel_id = message.channel.id
+    pending_deletes[channel_id].append(message)
+    if warn:
+        pending_warnings[channel_id].append(message.author)
+    if channel_id not in delete_flush_tasks:
+        delete_flush_tasks[channel_id] = asyncio.create_task(flush_deletes_soon(message.channel))
+
+async def flush_deletes_soon(channel):
+    await asyncio.sleep(DELETE_FLUSH_DELAY)
+    # Anything queued from here on schedules its own flush
+    del delete_flush_tasks[channel.id]
+    messages = pending_deletes.pop(channel.id, [])
+    warned = pending_warnings.pop(channel.id, [])
+
+    deleted = True
+    for i in range(0, len(messages), BULK_DELETE_LIMIT):
+        try:
+            await channel.delete_messages(messages[i:i + BULK_DELETE_LIMIT])
+        except discord.errors.Forbidden:
+            logger.warning("Can't delete messages - insufficient permissions")
+            deleted = False
+            break
+        except Exception as e:
+            logger.error("Error deleting messages: %s", e)
+            deleted = False
+
+    if not warned:
+        return
+    mentions = " ".join(dict.fromkeys(member.mention for member in warned))
+    try:
+        if deleted:
+            await channel.send(f"{mentions} Your message was removed as spam."
+                               f" Further violations will lead to a timeout.")
+        else:
+            await channel.send(f"{mentions} Your message was flagged as spam.")
+    except Exception as e:
+        logger.error("Error sending spam warning: %s", e)
+
+# Deletes a message the AI flagged and warns or times out its author
+async def handle_spam(message, acct_age: int, join_age: int):
+    logger.debug("Found spam!")
+    metrics.spam_detected += 1
+    save_metrics(metrics)
+    user_id = message.author.id
+    user_spam_detected[user_id] += 1
+    offenses = await record_shared_offense(user_id) or user_spam_detected[user_id]
+
+    message_logger.info(f"SPAM DETECTED | User: {message.author.name} ({message.author.id}) | "
+                        f"Channel: {message.channel.name} | "
+                        f"Account Age: {acct_age} days | "
+                        f"Server Age: {join_age} days | "
+                        f"Content: {message.content}")
+    # First offense gets a warning, sent with the channel's bulk delete
+    queue_delete(message, warn=offenses == 1)
+    if offenses > 1:
+        try:
+            timeout_mins = 10 * offenses # increases timeout length
+            await message.author.timeout(
+                timedelta(minutes=timeout_mins),
+                reason=f"Spam detected ({offenses} times)"
+            )
+            logging.info(f"Deleted spam from {message.author}: {message.content}")
+        except discord.errors.Forbidden:
+            logger.warning("Can't timeout user - insufficient permissions")
+        except Exception as e:
+            logger.error("Error timing out user: %s", e)
+
+    if metrics.spam_detected % 10 == 0:
+        print_metrics()
 
 # ------- Events -------
 
@@ -209,6 +870,17 @@ async def on_ready():
     print("\n")
     print_metrics()
 
+    # on_ready fires again after reconnects, only start background tasks once
+    global batch_worker_task, metrics_flusher_task, offline_batch_task, spam_state_flusher_task
+    if batch_worker_task is None or batch_worker_task.done():
+        batch_worker_task = asyncio.create_task(batch_worker())
+    if offline_batch_task is None or offline_batch_task.done():
+        offline_batch_task = asyncio.create_task(offline_batch_worker())
+    if metrics_flusher_task is None or metrics_flusher_task.done():
+        metrics_flusher_task = asyncio.create_task(metrics_flusher())
+    if spam_state_flusher_task is None or spam_state_flusher_task.done():
+        spam_state_flusher_task = asyncio.create_task(spam_state_flusher())
+
 # When a message is sent
 @bot.event
 async def on_message(message):
@@ -216,39 +888,47 @@ async def on_message(message):
     if message.author == bot.user:
         return
 
-    print("Message detected: " + message.content)
+    logger.debug("Message detected: %s", message.content)
 
     # Update metrics
-    metrics_data['total_messages'] += 1
+    metrics.total_messages += 1
 
-    # Check if possible spam
-    print("Checking if possible spam...")
-    try:
-        possibly_spam = check_if_possible_spam(message)
-    except Exception as e:
-        logging.exception(f"check_if_possible_spam crashed: {e}")
-        possibly_spam = False
+    # Check if possible spam, short messages skip every check
+    logger.debug("Checking if possible spam...")
+    possibly_spam = False
+    ages = AuthorAges(message.author)
+    if len(message.content) >= MIN_SUSPICIOUS_LENGTH:
+        try:
+            possibly_spam = check_if_possible_spam(message, ages)
+        except Exception as e:
+            logging.exception(f"check_if_possible_spam crashed: {e}")
     if not possibly_spam:
-        print("Likely safe!")
-        metrics_data["filtered_locally"] += 1
-        save_metrics(metrics_data)
+        logger.debug("Likely safe!")
+        metrics.filtered_locally += 1
+        save_metrics(metrics)
         await bot.process_commands(message)
         return
 
+    # Only suspicious messages need the author's ages, reusing any the check already looked up
+    acct_age = ages.account()
+    join_age = ages.join()
+
     user_id = message.author.id
-    user_spam_attempts[user_id].append(datetime.now())
+    attempts = user_spam_attempts[user_id]
+    attempt_time = time.monotonic()
+    attempts.append(attempt_time)
 
-    user_spam_attempts[user_id] = [
-        t for t in user_spam_attempts[user_id]
-        if (datetime.now() - t).total_seconds() < TIME_WINDOW
-    ]
+    # Drop attempts that fell out of the window, oldest are at the front
+    expired = bisect.bisect_right(attempts, attempt_time - TIME_WINDOW)
+    del attempts[:expired]
 
-    attempt_count = len(user_spam_attempts[user_id])
-    print(f"User {message.author.name} has {attempt_count} suspicious messages in last {TIME_WINDOW}s")
+    shared_count = await record_shared_attempt(user_id, message.id)
+    attempt_count = shared_count if shared_count is not None else len(attempts)
+    logger.debug("User %s has %d suspicious messages in last %ds", message.author.name, attempt_count, TIME_WINDOW)
 
     # Timeout repeat offenders
     if attempt_count >= MAX_SUS_MESSAGES:
-        print(f"🚨 Rate limit exceeded! Timing out {message.author.name}")
+        logger.info("Rate limit exceeded! Timing out %s", message.author.name)
         try:
             await message.author.timeout(TIMEOUT_DURATION, reason="Spam rate limit exceeded")
             await message.channel.send(
@@ -257,57 +937,36 @@ async def on_message(message):
             )
             message_logger.info(f"SPAM DETECTED | User: {message.author.name} ({message.author.id}) | "
                                 f"Channel: {message.channel.name} | "
-                                f"Account Age: {account_age_days(message.author)} days | "
-                                f"Server Age: {member_join_age_days(message.author)} days | "
+                                f"Account Age: {acct_age} days | "
+                                f"Server Age: {join_age} days | "
                                 f"Content: {message.content}")
-            await message.delete()
-            user_spam_attempts[user_id].clear()
-            metrics_data["filtered_locally"] += 1 # API call not wasted
-            save_metrics(metrics_data)
+            queue_delete(message)
+            del attempts[:]
+            await clear_shared_attempts(user_id)
+            metrics.filtered_locally += 1 # API call not wasted
+            save_metrics(metrics)
             await bot.process_commands(message)
             return
         except discord.errors.Forbidden:
-            print("Can't timeout user - insufficient permissions")
+            logger.warning("Can't timeout user - insufficient permissions")
         except Exception as e:
-            print(f"Error timing out user: {e}")
+            logger.error("Error timing out user: %s", e)
 
     # Check if spam
-    metrics_data['sent_to_api'] += 1
-    save_metrics(metrics_data)
-    print("Checking if spam by AI")
-    if await is_spam(message.content):
-        print("Found spam!")
-        metrics_data['spam_detected'] += 1
-        save_metrics(metrics_data)
-        user_spam_detected[user_id] += 1
-
-        try:
-            message_logger.info(f"SPAM DETECTED | User: {message.author.name} ({message.author.id}) | "
-                                f"Channel: {message.channel.name} | "
-                                f"Account Age: {account_age_days(message.author)} days | "
-                                f"Server Age: {member_join_age_days(message.author)} days | "
-                                f"Content: {message.content}")
-            await message.delete()
-            if user_spam_detected[user_id] == 1:
-                await message.channel.send(
-                    f"{message.author.mention} Your message was removed as spam."
-                    f" Further violations will lead to a timeout."
-                )
-            else:
-                timeout_mins = 10 * user_spam_detected[user_id] # increases timeout length
-                await message.author.timeout(
-                    timedelta(minutes=timeout_mins),
-                    reason=f"Spam detected ({user_spam_detected[user_id]} times)"
-                )
-                logging.info(f"Deleted spam from {message.author}: {message.content}")
-        except discord.errors.Forbidden:
-            print("Can't delete message or timeout user - insufficient permissions")
-            await message.channel.send(f"{message.author.mention} Your message was flagged as spam.")
-        except Exception as e:
-            print(f"Error deleting message: {e}")
-
-        if metrics_data["spam_detected"] % 10 == 0:
-            print_metrics()
+    metrics.sent_to_api += 1
+    save_metrics(metrics)
+    logger.debug("Checking if spam by AI")
+    # Near-duplicates of confirmed spam are likely part of a raid, so don't defer them
+    near_duplicate = looks_like_known_spam(message.content)
+    if near_duplicate:
+        logger.debug("Near-duplicate of known spam, classifying right away")
+    if acct_age < URGENT_ACCOUNT_AGE_DAYS or near_duplicate:
+        found_spam = await enqueue_for_classification(message.content)
+    else:
+        logger.debug("Established account, deferring to offline batch")
+        found_spam = await is_spam_offline(message)
+    if found_spam:
+        await handle_spam(message, acct_age, join_age)
 
     await bot.process_commands(message)
 
@@ -315,10 +974,13 @@ async def on_message(message):
 @bot.command(name="metrics")
 @commands.has_permissions(administrator=True)
 async def show_metrics(ctx):
-    total_messages = metrics_data['total_messages']
-    filtered_locally = metrics_data['filtered_locally']
-    api_calls = metrics_data['sent_to_api']
-    spam_detected = metrics_data['spam_detected']
+    # Totals across every shard when shared, otherwise just this instance
+    await push_shared_metrics()
+    totals = await load_shared_metrics() or asdict(metrics)
+    total_messages = totals['total_messages']
+    filtered_locally = totals['filtered_locally']
+    api_calls = totals['sent_to_api']
+    spam_detected = totals['spam_detected']
     if total_messages > 0:
         reduction = (filtered_locally / total_messages) * 100
         embed = discord.Embed(
@@ -335,4 +997,16 @@ async def show_metrics(ctx):
     else:
         await ctx.send("No messages processed yet")
 
-bot.run(token, log_handler=handler, log_level=logging.INFO)
\ No newline at end of file
+# Same as bot.run, but closes the OpenAI connection pool on the way out
+async def main():
+    try:
+        async with bot:
+            await bot.start(token)
+    finally:
+        await client.close()
+
+discord.utils.setup_logging(handler=handler, level=logging.INFO, root=False)
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
\ No newline at end of file